@@ -40,8 +40,8 @@ Options for -B/--backup:
         incremental backup, a full backup is necessary).
 
     -z / --gzip
-        Compress with gzip the backup files.  Uses the default uncompressed
-        level.  By default, gzip compression is not used.
+        Compress with gzip the backup files.  Uses compression level 6.
+        By default, gzip compression is not used.
 
     -k / --kill-old-on-full
         If a full backup is created, remove any prior full or incremental
@@ -59,12 +59,35 @@ Options for -R/--recover:
         Write recovered blobsorage to given directory.  This argument is
         required.
 """
+from __future__ import print_function
 
 import os
 import sys
+import errno
+import copy
+import shutil
 import time
 import getopt
+import gzip
+import json
+import subprocess
 import tarfile
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2
+    scandir = None
+
+try:
+    from os import fsdecode, fsencode
+except ImportError:
+    # Python 2: file names are byte strings already.
+    def fsencode(name):
+        return name
+    fsdecode = fsencode
 
 program = sys.argv[0]
 
@@ -74,6 +97,41 @@ RECOVER = 2
 COMMASPACE = ', '
 VERBOSE = False
 
+# Do not let the compressor inherit our end of the pipe to tar, otherwise
+# tar never sees the end of its file list.
+MUST_CLOSE_FDS = not sys.platform.startswith('win')
+
+# tarfile copies member data in 16KiB chunks, which means lots of small
+# reads and writes for a blobstorage.
+COPY_BUFSIZE = 2 * 1024 * 1024
+
+# Only Linux can sendfile() to a regular file; elsewhere the target must be
+# a socket.  Even there, some file systems do not support it: the errors
+# below mean we should copy the data ourselves instead.
+USE_SENDFILE = hasattr(os, 'sendfile') and sys.platform.startswith('linux')
+SENDFILE_UNSUPPORTED = (errno.ENOTSOCK, errno.EINVAL, errno.ENOSYS)
+
+# Blobs are mostly already compressed (images, pdfs), so the highest
+# compression level costs a lot of time for hardly any space.
+GZIP_LEVEL = 6
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Buffer sizes for the archive files themselves, so gzip and tarfile
+# exchange data with the disk in big blocks.
+READ_BUFSIZE = 256 * 1024
+WRITE_BUFSIZE = 1024 * 1024
+
+# Every backup file gets a sidecar listing its members, so we do not
+# have to read (and decompress) the whole archive to find out.
+MANIFEST_EXT = '.manifest'
+
+# Cache of the names in the backup files, see concat().
+INDEX_NAME = '.index.json'
+
+# Sizes and mtimes of the blobs at the time of the newest backup file, see
+# do_backup().
+BLOB_INDEX_NAME = '.blob-index'
+
 
 class WouldOverwriteFiles(Exception):
     pass
@@ -83,14 +141,88 @@ class NoFiles(Exception):
     pass
 
 
+class CommandFailed(Exception):
+    pass
+
+
+class BlobTarFile(tarfile.TarFile):
+    # TarFile that copies member data in COPY_BUFSIZE chunks.  When writing
+    # to a plain file, use_sendfile lets the kernel copy the data instead.
+
+    use_sendfile = False
+
+    def addfile(self, tarinfo, fileobj=None):
+        if fileobj is None:
+            return tarfile.TarFile.addfile(self, tarinfo)
+        self._check('aw')
+        tarinfo = copy.copy(tarinfo)
+        buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        self.fileobj.write(buf)
+        self.offset += len(buf)
+        if self.use_sendfile:
+            self.use_sendfile = send_data(fileobj, self.fileobj, tarinfo.size)
+        else:
+            copy_data(fileobj, self.fileobj, tarinfo.size)
+        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+        if remainder > 0:
+            self.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+            blocks += 1
+        self.offset += blocks * tarfile.BLOCKSIZE
+        self.members.append(tarinfo)
+
+    def makefile(self, tarinfo, targetpath):
+        source = self.extractfile(tarinfo)
+        try:
+            target = open(targetpath, 'wb')
+            try:
+                shutil.copyfileobj(source, target, COPY_BUFSIZE)
+            finally:
+                target.close()
+        finally:
+            source.close()
+
+
+def copy_data(src, dst, size):
+    # Copy exactly size bytes from src to dst.
+    while size > 0:
+        buf = src.read(min(size, COPY_BUFSIZE))
+        if not buf:
+            raise IOError('unexpected end of data')
+        dst.write(buf)
+        size -= len(buf)
+
+
+def send_data(src, dst, size):
+    # Copy exactly size bytes from src to dst with os.sendfile, so the data
+    # never passes through Python.  Both must be real files.  Return False
+    # when the kernel cannot do this for these files: then the (rest of
+    # the) data is copied with copy_data, and callers should not try again.
+    dst.flush()
+    offset = 0
+    while offset < size:
+        try:
+            sent = os.sendfile(dst.fileno(), src.fileno(), offset,
+                               size - offset)
+        except OSError as e:
+            if e.errno not in SENDFILE_UNSUPPORTED:
+                raise
+            src.seek(offset)
+            copy_data(src, dst, size - offset)
+            return False
+        if not sent:
+            raise IOError('unexpected end of data')
+        offset += sent
+    return True
+
+
 def usage(code, msg=''):
     outfp = sys.stderr
     if code == 0:
         outfp = sys.stdout
 
-    print >> outfp, __doc__ % globals()
+    print(__doc__ % {'program': program}, file=outfp)
     if msg:
-        print >> outfp, msg
+        print(msg, file=outfp)
 
     sys.exit(code)
 
@@ -98,7 +230,7 @@ def usage(code, msg=''):
 def log(msg, *args):
     if VERBOSE:
         # Use stderr here so that -v flag works with -R and no -o
-        print >> sys.stderr, msg % args
+        print(msg % args, file=sys.stderr)
 
 
 def parseargs(argv):
@@ -117,7 +249,7 @@ def parseargs(argv):
                                     'date=',
                                     'output=',
                                    ])
-    except getopt.error, msg:
+    except getopt.error as msg:
         usage(1, msg)
 
     class Options:
@@ -129,6 +261,7 @@ def parseargs(argv):
         output = None       # where to write recovered data; None = stdout
         gzip = False        # -z flag state
         killold = None      # -k flag state
+        now = None          # time used in file names, see gen_filename
 
     options = Options()
 
@@ -172,6 +305,8 @@ def parseargs(argv):
     if options.repository is None:
         usage(1, '--repository is required')
     if options.mode == BACKUP:
+        if options.blob is None:
+            usage(1, '--blobstorage is required')
         if options.date is not None:
             log('--date option is ignored in backup mode')
             options.date = None
@@ -189,17 +324,263 @@ def parseargs(argv):
     return options
 
 
+def read_manifest(path):
+    # Return the names listed in the manifest of backup file path, or None
+    # when there is no manifest (backups made by older versions).
+    try:
+        f = open(path + MANIFEST_EXT)
+    except IOError:
+        return None
+    try:
+        return f.read().splitlines()
+    finally:
+        f.close()
+
+
+def write_manifest(path, names):
+    f = open(path + MANIFEST_EXT, 'w')
+    try:
+        for name in names:
+            f.write(name + '\n')
+    finally:
+        f.close()
+
+
+def read_names(path):
+    """Return the names of the members of backup file path.
+
+    Every backup file gets a manifest with the names in it:
+
+      >>> mkdir('blobstorage')
+      >>> mkdir('blobstorage', '0x01')
+      >>> write('blobstorage', '0x01', 'a.blob', 'Sample blob.')
+      >>> mkdir('backups')
+      >>> run(['-B', '-b', 'blobstorage', '-r', 'backups'])
+      0
+      >>> ls('backups')
+      -  .blob-index
+      -  .index.json
+      -  ....blobs
+      -  ....blobs.manifest
+      >>> backup = join('backups', sorted(os.listdir('backups'))[2])
+      >>> read_manifest(backup)
+      ['0x01', '0x01/a.blob']
+      >>> read_names(backup)
+      ['0x01', '0x01/a.blob']
+
+    Backup files made by older versions have no manifest.  We read the
+    backup file itself then:
+
+      >>> remove(backup + MANIFEST_EXT)
+      >>> print(read_manifest(backup))
+      None
+      >>> read_names(backup)
+      ['0x01', '0x01/a.blob']
+
+    """
+    manifest = read_manifest(path)
+    if manifest is not None:
+        return manifest
+    log("Reading list %s", path)
+    names = [member.name for tar, member in iter_members(path)]
+    log(".")
+    return names
+
+
+def iter_members(path):
+    # Yield (tarfile, member) for the members of backup file path, reading
+    # it once from start to end.  We add a GzipFile ourselves when the file
+    # is gzipped: tarfile's own compression support ('r:*' or 'r|*') would
+    # put another buffering layer between the file and zlib.
+    raw = open(path, 'rb', READ_BUFSIZE)
+    try:
+        fileobj = raw
+        gzipped = raw.read(2) == GZIP_MAGIC
+        raw.seek(0)
+        if gzipped:
+            fileobj = gzip.GzipFile(mode='rb', fileobj=raw)
+        tar = BlobTarFile.open(fileobj=fileobj, mode='r:')
+        for member in tar:
+            yield tar, member
+        tar.close()
+        if fileobj is not raw:
+            fileobj.close()
+    finally:
+        raw.close()
+
+
+def load_json(path):
+    # Return the dict stored in json file path, or an empty dict when there
+    # is no usable file.  We use json rather than pickle for the files we
+    # keep in the repository: loading a pickle can run arbitrary code.
+    try:
+        f = open(path)
+    except IOError:
+        return {}
+    try:
+        data = json.load(f)
+    except ValueError:
+        data = None
+    finally:
+        f.close()
+    if not isinstance(data, dict):
+        log('ignoring unreadable index %s', path)
+        return {}
+    return data
+
+
+def save_json(path, data):
+    # Blob names are plain ascii, but on Python 2 json cannot store names
+    # that are not utf-8.  The indexes are only a cache, so the next run
+    # simply does without then.
+    try:
+        text = json.dumps(data)
+    except UnicodeError:
+        log('cannot write index %s', path)
+        return
+    f = open(path, 'w')
+    try:
+        f.write(text)
+    finally:
+        f.close()
+
+
+def load_index(path):
+    # Return the index of backup file names to (mtime, names), or an empty
+    # dict when there is no usable index.
+    index = {}
+    try:
+        for key, (mtime, names) in load_json(path).items():
+            index[key] = (mtime, frozenset(names))
+    except (TypeError, ValueError):
+        log('ignoring unreadable index %s', path)
+        return {}
+    return index
+
+
+def save_index(path, index):
+    save_json(path, dict((key, (mtime, sorted(names)))
+                         for key, (mtime, names) in index.items()))
+
+
+def add_to_index(options, dest, names):
+    # Remember the names in the backup file we just wrote, so the next run
+    # does not have to read it (or even its manifest).  A full backup
+    # starts a new chain, so it starts a new index too.
+    index_path = os.path.join(options.repository, INDEX_NAME)
+    if options.full:
+        index = {}
+    else:
+        index = load_index(index_path)
+    index[os.path.basename(dest)] = (os.path.getmtime(dest), frozenset(names))
+    save_index(index_path, index)
+
+
 def concat(files):
-    # Concatenate a bunch of files from the repository.
-    names = []
+    """Return the names in a bunch of backup files from the repository.
+
+    The names in each file are cached in an index in the repository, so a
+    run only has to read the files that were added (or changed) since the
+    previous run.
+
+      >>> mkdir('backups')
+      >>> write('backups', '2024-01-01-00-00-00.blobs', 'dummycontents')
+      >>> write('backups', '2024-01-01-00-00-00.blobs.manifest',
+      ...       '0x01\\n0x01/a.blob\\n')
+      >>> write('backups', '2024-01-02-00-00-00.deltablobs', 'dummycontents')
+      >>> write('backups', '2024-01-02-00-00-00.deltablobs.manifest',
+      ...       '0x01/b.blob\\n')
+      >>> files = [join('backups', '2024-01-01-00-00-00.blobs'),
+      ...          join('backups', '2024-01-02-00-00-00.deltablobs')]
+      >>> for name in sorted(concat(files)):
+      ...     print(name)
+      0x01
+      0x01/a.blob
+      0x01/b.blob
+      >>> ls('backups')
+      -  .index.json
+      -  2024-01-01-00-00-00.blobs
+      -  2024-01-01-00-00-00.blobs.manifest
+      -  2024-01-02-00-00-00.deltablobs
+      -  2024-01-02-00-00-00.deltablobs.manifest
+
+    The next time, the names come from the index, so we do not even need
+    the manifests:
+
+      >>> remove('backups', '2024-01-01-00-00-00.blobs.manifest')
+      >>> remove('backups', '2024-01-02-00-00-00.deltablobs.manifest')
+      >>> for name in sorted(concat(files)):
+      ...     print(name)
+      0x01
+      0x01/a.blob
+      0x01/b.blob
+
+    A backup file that has changed since is read again:
+
+      >>> write('backups', '2024-01-02-00-00-00.deltablobs.manifest',
+      ...       '0x01/c.blob\\n')
+      >>> os.utime(join('backups', '2024-01-02-00-00-00.deltablobs'),
+      ...          (1000, 1000))
+      >>> for name in sorted(concat(files)):
+      ...     print(name)
+      0x01
+      0x01/a.blob
+      0x01/c.blob
+
+    An index we cannot read is ignored:
+
+      >>> write('backups', INDEX_NAME, 'garbage')
+      >>> write('backups', '2024-01-01-00-00-00.blobs.manifest',
+      ...       '0x01\\n0x01/a.blob\\n')
+      >>> for name in sorted(concat(files)):
+      ...     print(name)
+      0x01
+      0x01/a.blob
+      0x01/c.blob
+
+    """
+    if not files:
+        return set()
+    index_path = os.path.join(os.path.dirname(files[0]), INDEX_NAME)
+    index = load_index(index_path)
+    new_index = {}
+    missing = []
     for f in files:
-        # Auto uncompress
-        log("Reading list %s", f)
-        x = tarfile.open(f, 'r:*')
-        names.extend(x.getnames())
-        x.close()
-        log(".")
-    return set(names)
+        key = os.path.basename(f)
+        mtime = os.path.getmtime(f)
+        cached = index.get(key)
+        if cached is not None and cached[0] == mtime:
+            new_index[key] = cached
+        else:
+            missing.append((f, key, mtime))
+    read = read_all_names([f for f, key, mtime in missing])
+    for (f, key, mtime), members in zip(missing, read):
+        new_index[key] = (mtime, frozenset(members))
+    # Also save when files dropped out of the list, to forget about them.
+    if missing or len(new_index) != len(index):
+        save_index(index_path, new_index)
+    names = set()
+    for mtime, members in new_index.values():
+        names.update(members)
+    return names
+
+
+def read_all_names(paths):
+    # Return the names of the members of each of the backup files.  Read
+    # several archives in parallel: zlib releases the GIL while
+    # decompressing, so threads really help here.
+    if len(paths) < 2:
+        return [read_names(path) for path in paths]
+    try:
+        workers = min(len(paths), cpu_count())
+    except NotImplementedError:
+        workers = 2
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(read_names, paths)
+    finally:
+        pool.close()
+        pool.join()
 
 
 def gen_filename(options, ext=None):
@@ -208,44 +589,285 @@ def gen_filename(options, ext=None):
             ext = '.blobs'
         else:
             ext = '.deltablobs'
-    # Hook for testing
-    now = getattr(options, 'test_now', time.gmtime()[:6])
-    t = now + (ext,)
-    return '%04d-%02d-%02d-%02d-%02d-%02d%s' % t
-
-def listd(base="", prefix="", ll=[]):
-    if prefix:
-        ll.append(prefix)
-    if os.path.isdir(os.path.join(base, prefix)):
-        for i in os.listdir(os.path.join(base, prefix)):
-            listd(base, os.path.join(prefix, i), ll)
-    return ll
+    # Use the same time for all file names in one run, so they cannot
+    # straddle a second boundary.  test_now is a hook for testing.
+    now = getattr(options, 'test_now', None)
+    if now is None:
+        if options.now is None:
+            options.now = time.gmtime()[:6]
+        now = options.now
+    return '%04d-%02d-%02d-%02d-%02d-%02d' % now + ext
+
+
+def scan(dirname):
+    # Return (path, isdir) for all entries in dirname.  A directory that was
+    # removed while we were walking counts as empty; any other error (like
+    # an unreadable directory) is raised, so blobs are never skipped
+    # silently.  Symlinks to directories are not counted as directories,
+    # like tar does not follow them either.
+    try:
+        if scandir is not None:
+            return [(entry.path, entry.is_dir(follow_symlinks=False))
+                    for entry in scandir(dirname)]
+        names = os.listdir(dirname)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return []
+    paths = [os.path.join(dirname, name) for name in names]
+    return [(path, os.path.isdir(path) and not os.path.islink(path))
+            for path in paths]
+
+
+def walk(base):
+    # Yield (name, path, isdir) for all files and directories below base,
+    # where name is the path relative to base.
+    baselen = len(os.path.join(base, ''))
+    stack = [base]
+    while stack:
+        for path, isdir in scan(stack.pop()):
+            yield path[baselen:], path, isdir
+            if isdir:
+                stack.append(path)
+
+
+def listd(base):
+    # Yield all files and directories below base, relative to base.
+    for name, path, isdir in walk(base):
+        yield name
+
+
+def listd_stats(base):
+    # Yield (name, stat) for all files and directories below base, where
+    # stat is (size, mtime) for files.  It is None for directories: their
+    # mtime changes whenever a blob is added, which is no reason to back
+    # them up again.  The mtime is in whole seconds, as tar keeps it: after
+    # a restore the blobs must still look the same as in the backup.
+    for name, path, isdir in walk(base):
+        if isdir:
+            yield name, None
+            continue
+        try:
+            st = os.lstat(path)
+        except OSError:
+            # Removed while we were looking.
+            continue
+        yield name, (st.st_size, int(st.st_mtime))
+
+
+def which(program):
+    # Return the full path of program when it is on the PATH, else None.
+    for dirname in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(dirname, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def find_tar():
+    # Return the path of GNU tar, or None when it is not available.  We
+    # depend on GNU options (--files-from, --no-recursion, and the verbose
+    # listing on stdout), so other tar implementations are not used.
+    tar = which('tar')
+    if tar is None:
+        return None
+    try:
+        p = subprocess.Popen([tar, '--version'], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        version = p.communicate()[0]
+    except OSError:
+        return None
+    if b'GNU tar' not in version:
+        return None
+    return tar
+
+
+def find_compressor():
+    # pigz compresses on all cores; plain gzip is the fallback.
+    return which('pigz') or which('gzip')
+
+
+def is_gzipped(path):
+    f = open(path, 'rb')
+    try:
+        return f.read(2) == GZIP_MAGIC
+    finally:
+        f.close()
+
+
+def tar_create(tar, compressor, options, dest, names):
+    # Archive names (relative to the blobstorage) to dest with external
+    # tar, piped through the compressor when gzip is requested.  The names
+    # are passed on stdin to avoid command line length limits.  They list
+    # every file and directory, so tar should not recurse.  With --null,
+    # tar takes them literally: no unquoting, and names starting with a
+    # dash are not options.
+    command = [tar, '--create', '--directory=' + options.blob,
+               '--no-recursion', '--null', '--files-from=-']
+    out = open(dest, 'wb')
+    try:
+        if compressor is None:
+            tar_proc = subprocess.Popen(command + ['--file=-'],
+                                        stdin=subprocess.PIPE, stdout=out,
+                                        close_fds=MUST_CLOSE_FDS)
+            gzip_proc = None
+        else:
+            tar_proc = subprocess.Popen(command + ['--file=-'],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        close_fds=MUST_CLOSE_FDS)
+            gzip_proc = subprocess.Popen([compressor, '-c',
+                                          '-%d' % GZIP_LEVEL],
+                                         stdin=tar_proc.stdout, stdout=out,
+                                         close_fds=MUST_CLOSE_FDS)
+            tar_proc.stdout.close()
+        for name in names:
+            tar_proc.stdin.write(fsencode(name) + b'\0')
+        tar_proc.stdin.close()
+        # tar exits with 1 when a file changed while it was read; the
+        # archive is still usable then.
+        failed = tar_proc.wait() > 1
+        if gzip_proc is not None:
+            failed = gzip_proc.wait() != 0 or failed
+    finally:
+        out.close()
+    if failed:
+        os.remove(dest)
+        raise CommandFailed('Could not write backup file: %s' % dest)
+
+
+def tar_extract(tar, compressor, item, output):
+    # Extract item into output with external tar and return the names of
+    # the members, as listed by tar.
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    command = [tar, '--extract', '--verbose', '--quoting-style=literal',
+               '--directory=' + output]
+    if compressor is not None and is_gzipped(item):
+        gzip_proc = subprocess.Popen([compressor, '-d', '-c', item],
+                                     stdout=subprocess.PIPE,
+                                     close_fds=MUST_CLOSE_FDS)
+        tar_proc = subprocess.Popen(command + ['--file=-'],
+                                    stdin=gzip_proc.stdout,
+                                    stdout=subprocess.PIPE,
+                                    close_fds=MUST_CLOSE_FDS)
+        gzip_proc.stdout.close()
+    else:
+        # GNU tar detects compression itself when reading from a file.
+        gzip_proc = None
+        tar_proc = subprocess.Popen(command + ['--file=' + item],
+                                    stdout=subprocess.PIPE,
+                                    close_fds=MUST_CLOSE_FDS)
+    listing = tar_proc.communicate()[0]
+    failed = tar_proc.returncode != 0
+    if gzip_proc is not None:
+        failed = gzip_proc.wait() != 0 or failed
+    if failed:
+        raise CommandFailed('Could not extract backup file: %s' % item)
+    # Directories are listed with a trailing slash.
+    return [fsdecode(name).rstrip('/') for name in listing.splitlines()
+            if name]
+
+
+def write_archive(options, dest, names):
+    # Write names (relative to the blobstorage) to dest, plus its manifest.
+    # Use external tar when we can, as it is a lot faster than the tarfile
+    # module.
+    tar = find_tar()
+    compressor = None
+    if options.gzip:
+        compressor = find_compressor()
+    if tar is not None and (compressor is not None or not options.gzip):
+        tar_create(tar, compressor, options, dest, names)
+    else:
+        write_tarfile(options, dest, names)
+    write_manifest(dest, names)
+    add_to_index(options, dest, names)
+
+
+def write_tarfile(options, dest, names):
+    raw = open(dest, 'wb', WRITE_BUFSIZE)
+    try:
+        if options.gzip:
+            fileobj = gzip.GzipFile(mode='wb', compresslevel=GZIP_LEVEL,
+                                    fileobj=raw)
+        else:
+            fileobj = raw
+        fs = BlobTarFile.open(mode='w:', fileobj=fileobj)
+        fs.use_sendfile = fileobj is raw and USE_SENDFILE
+        for item in names:
+            fs.add(os.path.join(options.blob, item), item, recursive=False)
+        fs.close()
+        if fileobj is not raw:
+            fileobj.close()
+    finally:
+        raw.close()
+
 
 # Return a list of files needed to reproduce state at time options.date.
 # This is a list, in chronological order, of the .blobs and .deltablobs
 # files, from the time of the most recent full backup preceding
 # options.date, up to options.date.
 
-import re
-is_data_file = re.compile(r'\d{4}(?:-\d\d){5}\.(?:delta)?blobs$').match
-del re
+DATA_EXTENSIONS = ('.blobs', '.deltablobs')
+
+
+def is_data_file(fname):
+    """Is fname a backup file?
+
+    Backup files have the names made by gen_filename:
+    yyyy-mm-dd-hh-mm-ss.blobs or .deltablobs.  Simple string checks are a
+    lot cheaper than a regex for repositories with thousands of files.
+
+      >>> is_data_file('2024-01-02-03-04-05.blobs')
+      True
+      >>> is_data_file('2024-01-02-03-04-05.deltablobs')
+      True
+
+    Manifests, indexes and other files in the repository are not backup
+    files:
+
+      >>> is_data_file('2024-01-02-03-04-05.blobs.manifest')
+      False
+      >>> is_data_file('.index.json')
+      False
+      >>> is_data_file('2024-01-02-03-04-05.fs')
+      False
+
+    Neither are names that only look a bit like a date:
+
+      >>> is_data_file('x.blobs')
+      False
+      >>> is_data_file('2024-0--02-03-04-05.blobs')
+      False
+      >>> is_data_file('2024_01_02_03_04_05.blobs')
+      False
+      >>> is_data_file('2024-01-02-03-04-055.blobs')
+      False
+
+    """
+    if not fname.endswith(DATA_EXTENSIONS):
+        return False
+    root = fname[:fname.rindex('.')]
+    return (len(root) == 19 and root[4::3] == '-----' and
+            root.count('-') == 5 and root.replace('-', '').isdigit())
+
 
 def find_files(options):
     when = options.date
     if not when:
         when = gen_filename(options, '')
     log('looking for files between last full backup and %s...', when)
-    all = filter(is_data_file, os.listdir(options.repository))
-    all.sort()
+    all = sorted(filter(is_data_file, os.listdir(options.repository)))
     all.reverse()   # newest file first
     # Find the last full backup before date, then include all the
     # incrementals between that full backup and "when".
     needed = []
     for fname in all:
-        root, ext = os.path.splitext(fname)
+        root, ext = fname.rsplit('.', 1)
         if root <= when:
             needed.append(fname)
-            if ext in ('.blobs'):
+            if ext == 'blobs':
                 break
     # Make the file names relative to the repository directory
     needed = [os.path.join(options.repository, f) for f in needed]
@@ -261,18 +883,34 @@ def find_files(options):
 
 
 def delete_old_backups(options):
-    # Delete all full backup files except for the most recent full backup file
-    all = filter(is_data_file, os.listdir(options.repository))
-    all.sort()
+    """Delete all backup files except for the most recent full backup file.
+
+    Their manifests are removed with them.  Backup files made by older
+    versions have no manifest, which is fine too:
+
+      >>> mkdir('backups')
+      >>> write('backups', '2023-12-31-00-00-00.blobs', 'dummycontents')
+      >>> for name in ['2024-01-01-00-00-00.blobs',
+      ...              '2024-01-02-00-00-00.deltablobs',
+      ...              '2024-01-03-00-00-00.blobs']:
+      ...     write('backups', name, 'dummycontents')
+      ...     write('backups', name + MANIFEST_EXT, 'dummycontents')
+      >>> class Options:
+      ...     repository = 'backups'
+      >>> delete_old_backups(Options())
+      >>> ls('backups')
+      -  2024-01-03-00-00-00.blobs
+      -  2024-01-03-00-00-00.blobs.manifest
+
+    """
+    all = sorted(filter(is_data_file, os.listdir(options.repository)))
 
     deletable = []
     full = []
     for fname in all:
-        root, ext = os.path.splitext(fname)
-        if ext in ('.blobs'):
+        if fname.endswith('.blobs'):
             full.append(fname)
-        if ext in ('.blobs', '.deltablobs'):
-            deletable.append(fname)
+        deletable.append(fname)
 
     # keep most recent full
     if not full:
@@ -281,56 +919,109 @@ def delete_old_backups(options):
     recentfull = full.pop(-1)
     deletable.remove(recentfull)
 
+    base = os.path.join(options.repository, '')
     for fname in deletable:
         log('removing old backup file %s', fname)
-        os.unlink(os.path.join(options.repository, fname))
+        path = base + fname
+        os.unlink(path)
+        if os.path.exists(path + MANIFEST_EXT):
+            os.unlink(path + MANIFEST_EXT)
+
+
+def check_blobstorage(options):
+    # A missing blobstorage would look like an empty one: we would write an
+    # empty backup, and with -k remove the real ones.
+    if not os.path.isdir(options.blob):
+        raise NoFiles('Blobstorage directory not found: %s' % options.blob)
 
 
-def do_full_backup(options):
+def do_full_backup(options, blobstats=None):
+    check_blobstorage(options)
     options.full = True
     dest = os.path.join(options.repository, gen_filename(options))
     if os.path.exists(dest):
         raise WouldOverwriteFiles('Cannot overwrite existing file: %s' % dest)
     log('writing full backup to %s', dest)
-    fs = tarfile.open(dest, options.gzip and 'w:gz' or 'w:')
-    for item in os.listdir(options.blob):
-        fs.add(os.path.join(options.blob, item), item)
-    fs.close()
+    if blobstats is None:
+        blobstats = dict(listd_stats(options.blob))
+    write_archive(options, dest, list(blobstats))
+    save_blob_index(options, dest, blobstats)
     if options.killold:
         delete_old_backups(options)
 
 
-def do_incremental_backup(options, delta, repofiles):
+def do_incremental_backup(options, delta, repofiles, blobstats):
     options.full = False
     dest = os.path.join(options.repository, gen_filename(options))
     if os.path.exists(dest):
         raise WouldOverwriteFiles('Cannot overwrite existing file: %s' % dest)
-    fs = tarfile.open(dest, options.gzip and 'w:gz' or 'w:')
-    for item in delta:
-        fs.add(os.path.join(options.blob, item), item)
-    fs.close()
+    log('writing incremental backup to %s', dest)
+    write_archive(options, dest, delta)
+    save_blob_index(options, dest, blobstats)
+
+
+def load_blob_index(options):
+    # Return (archive, blobstats) from the blob index in the repository, or
+    # (None, None) when there is no usable one.
+    data = load_json(os.path.join(options.repository, BLOB_INDEX_NAME))
+    try:
+        blobstats = dict((name, stat and tuple(stat))
+                         for name, stat in data['blobs'].items())
+        return data['archive'], blobstats
+    except (KeyError, TypeError, AttributeError):
+        return None, None
+
+
+def save_blob_index(options, dest, blobstats):
+    # Remember what the blobstorage looked like when we wrote backup file
+    # dest, so the next backup can compare sizes and mtimes with that.
+    save_json(os.path.join(options.repository, BLOB_INDEX_NAME),
+              {'archive': os.path.basename(dest), 'blobs': blobstats})
 
 
 def do_backup(options):
+    check_blobstorage(options)
     repofiles = find_files(options)
     # See if we need to do a full backup
     if options.full or not repofiles:
         log('doing a full backup')
         do_full_backup(options)
         return
-    blobfiles = set(listd(options.blob, "", []))
-    backupfiles = concat(repofiles)
-    # Has nothing changed?
-    if backupfiles == blobfiles:
-        log('No changes, nothing to do')
-        return
+    # Compare with the blob index when it belongs to the newest backup
+    # file.  Otherwise we only know the names in the backups.
+    archive, indexstats = load_blob_index(options)
+    indexed = archive == os.path.basename(repofiles[-1])
+    if indexed:
+        known = indexstats
+    else:
+        known = dict.fromkeys(concat(repofiles))
+    # Compare in a single walk over the blobstorage: collect the names that
+    # are new or changed, and count the ones that are backed up already.
+    blobstats = {}
+    delta = []
+    found = 0
+    for name, stat in listd_stats(options.blob):
+        blobstats[name] = stat
+        if name not in known:
+            delta.append(name)
+            continue
+        found += 1
+        if known[name] is not None and known[name] != stat:
+            # Blobs should not change, but if one does, back it up again.
+            delta.append(name)
     # Has the file shrunk, probably because of a pack?
-    if not backupfiles.issubset(blobfiles):
+    if found < len(known):
         log('blobstorage changed, possibly because of a pack (full backup)')
-        do_full_backup(options)
+        do_full_backup(options, blobstats)
+        return
+    # Has nothing changed?
+    if not delta:
+        log('No changes, nothing to do')
+        if not indexed:
+            save_blob_index(options, repofiles[-1], blobstats)
         return
     log('doing incremental')
-    do_incremental_backup(options, blobfiles.difference(backupfiles), repofiles)
+    do_incremental_backup(options, delta, repofiles, blobstats)
     return
 
 
@@ -339,43 +1030,66 @@ def do_recover(options):
     repofiles = find_files(options)
     if not repofiles:
         if options.date:
-            raise NoFiles('No files in repository before %s', options.date)
+            raise NoFiles('No files in repository before %s' % options.date)
         else:
             raise NoFiles('No files in repository')
     if options.output is None:
         log('--output is required')
         return
     log('Recovering files to %s', options.output)
-    blobfiles = set(listd(options.output, "", []))
-    backupfiles = []
+    # Only needed for iterating over, so a list is enough.
+    blobfiles = list(listd(options.output))
+    backupfiles = set()
+    tar = find_tar()
+    compressor = find_compressor()
     for item in repofiles:
-        f = tarfile.open(item, 'r:*')
-        f.extractall(options.output)
-        backupfiles.extend(f.getnames())
-        f.close()
+        # Like in write_archive, only use tar when it does not need a
+        # compressor we do not have: it would fail to run gzip otherwise.
+        if tar is not None and (compressor is not None or
+                                not is_gzipped(item)):
+            backupfiles.update(tar_extract(tar, compressor, item,
+                                           options.output))
+        else:
+            # Extract the members as we read them, in a single pass.
+            for f, member in iter_members(item):
+                f.extract(member, options.output)
+                backupfiles.add(member.name)
         log('Recovered %s', item)
-    oldblobs = blobfiles - set(backupfiles)
-    for blob in oldblobs:
-        os.remove(os.path.join(options.output, blob))
+    base = os.path.join(options.output, '')
+    for blob in blobfiles:
+        if blob not in backupfiles:
+            os.unlink(base + blob)
+
+
+def run(argv):
+    # Run with the given command line arguments and return the exit code.
+    # This lets repoborunner call us in-process instead of via bin/repobo.
+    # Errors are printed instead of raised, like they would be when running
+    # as a script.
+    try:
+        options = parseargs(argv)
+    except SystemExit as e:
+        # usage() was called, and has printed the problem already.
+        return e.code or 0
+    try:
+        if options.mode == BACKUP:
+            do_backup(options)
+        else:
+            assert options.mode == RECOVER
+            do_recover(options)
+    except (WouldOverwriteFiles, NoFiles, CommandFailed,
+            EnvironmentError, tarfile.TarError) as e:
+        print(str(e), file=sys.stderr)
+        return 1
+    return 0
 
 
 def main(argv=None):
     if argv is None:
         argv = sys.argv[1:]
-    options = parseargs(argv)
-    if options.mode == BACKUP:
-        try:
-            do_backup(options)
-        except WouldOverwriteFiles, e:
-            print >> sys.stderr, str(e)
-            sys.exit(1)
-    else:
-        assert options.mode == RECOVER
-        try:
-            do_recover(options)
-        except NoFiles, e:
-            print >> sys.stderr, str(e)
-            sys.exit(1)
+    result = run(argv)
+    if result:
+        sys.exit(result)
 
 
 if __name__ == '__main__':
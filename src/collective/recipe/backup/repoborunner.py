@@ -2,45 +2,41 @@
 
 There are three main methods, these get called by the generated scripts. So
 backup_main() for bin/backup, snapshot_main() for bin/snapshotbackup and
-restore_main() for bin/restore.
+restore_main() for bin/restore.  They run repobo in-process instead of
+calling bin/repobo.
 
 backup_arguments() and restore_arguments() determine the arguments that are to
-be passed to bin/repobo.
+be passed to repobo.
 
 cleanup() empties old backups from the backup directory to prevent it from
 filling up the harddisk.
 
 """
 from operator import itemgetter
+import heapq
 import logging
 import os
-import sys
 
-logger = logging.getLogger('repoborunner')
+from collective.recipe.backup import repobo
+
+try:
+    from os import scandir
+except ImportError:
+    # Python 2
+    scandir = None
 
+# Can we unlink relative to an open directory?  Not on Python 2 or Windows.
+USE_DIR_FD = os.unlink in getattr(os, 'supports_dir_fd', ())
 
-def quote_command(command):
-    # Quote the program name, so it works even if it contains spaces
-    command = " ".join(['"%s"' % x for x in command])
-    if sys.platform[:3].lower() == 'win':
-        # odd, but true: the windows cmd processor can't handle more than
-        # one quoted item per string unless you add quotes around the
-        # whole line.
-        command = '"%s"' % command
-    return command
+logger = logging.getLogger('repoborunner')
 
 
 def backup_main(bin_dir, blobs, backup_location, keep, full, verbose, gzip):
     """Main method, gets called by generated bin/backup."""
-    repobo = os.path.join(bin_dir, 'repobo')
-
     logger.info("Please wait while backing up blobs: %s to %s",
                 blobs, backup_location)
-    result = os.system(quote_command([repobo] +
-                            backup_arguments(blobs,
-                                             backup_location, full,
-                                             verbose, gzip,
-                                             as_list=True)))
+    result = repobo.run(backup_arguments(blobs, backup_location, full,
+                                         verbose, gzip, as_list=True))
     logger.debug("Repobo command executed.")
     if result:
         logger.error("Repobo command failed. See message above.")
@@ -50,14 +46,11 @@ def backup_main(bin_dir, blobs, backup_location, keep, full, verbose, gzip):
 
 def snapshot_main(bin_dir, blobs, snapshot_location, keep, verbose, gzip):
     """Main method, gets called by generated bin/snapshotbackup."""
-    repobo = os.path.join(bin_dir, 'repobo')
-
     logger.info("Please wait while making snapshot of blobs: %s to %s",
                 blobs, snapshot_location)
-    result = os.system(quote_command([repobo] +
-                            backup_arguments(blobs, snapshot_location,
-                                             full=True, verbose=verbose,
-                                             gzip=gzip, as_list=True)))
+    result = repobo.run(backup_arguments(blobs, snapshot_location,
+                                         full=True, verbose=verbose,
+                                         gzip=gzip, as_list=True))
     logger.debug("Repobo command executed.")
     if result:
         logger.error("Repobo command failed. See message above.")
@@ -67,14 +60,12 @@ def snapshot_main(bin_dir, blobs, snapshot_location, keep, verbose, gzip):
 
 def restore_main(bin_dir, blobs, backup_location, verbose, date=None):
     """Main method, gets called by generated bin/restore."""
-    repobo = os.path.join(bin_dir, 'repobo')
     logger.debug("If things break: did you stop zope?")
 
     logger.info("Please wait while restoring blobs: %s to %s",
                 backup_location, blobs)
-    result = os.system(quote_command([repobo] +
-                            restore_arguments(blobs, backup_location,
-                                              date, verbose, as_list=True)))
+    result = repobo.run(restore_arguments(blobs, backup_location, date,
+                                          verbose, as_list=True))
     logger.debug("Repobo command executed.")
     if result:
         logger.error("Repobo command failed. See message above.")
@@ -271,44 +262,35 @@ def cleanup(backup_location, keep=0):
             "Value of 'keep' is %r, we don't want to remove anything.", keep)
         return
     logger.debug("Trying to clean up old backups.")
-    filenames = os.listdir(backup_location)
+    files_modtimes = list_modtimes(backup_location)
     logger.debug("Looked up filenames in the target dir: %s found. %r.",
-              len(filenames), filenames)
+              len(files_modtimes), [f[0] for f in files_modtimes])
     num_backups = int(keep)
     logger.debug("Max number of backups: %s.", num_backups)
-    files_modtimes = []
-    for filename in filenames:
-        mod_time = os.path.getmtime(os.path.join(backup_location, filename))
-        file_ = (filename, mod_time)
-        files_modtimes.append(file_)
     # we are only interested in full backups
     fullbackups = [f for f in files_modtimes
                    if f[0].endswith('.blobs')]
     logger.debug("Filtered out full backups (*.blobs): %r.",
               [f[0] for f in fullbackups])
-    fullbackups = sorted(fullbackups, key=itemgetter(1))
     logger.debug("%d fullbackups: %r", len(fullbackups), fullbackups)
     if len(fullbackups) > num_backups and num_backups != 0:
         logger.debug("There are older backups that we can remove.")
-        fullbackups.reverse()
-        logger.debug("Full backups, sorted by date, newest first: %r.",
-                  [f[0] for f in fullbackups])
-        oldest_backup_to_keep = fullbackups[(num_backups - 1)]
+        # Only the newest num_backups matter, no need to sort them all.
+        kept = heapq.nlargest(num_backups, fullbackups, key=itemgetter(1))
+        logger.debug("Full backups to keep, sorted by date, newest first: "
+                     "%r.", [f[0] for f in kept])
+        oldest_backup_to_keep = kept[-1]
         logger.debug("Oldest backup to keep: %s", oldest_backup_to_keep[0])
         last_date_to_keep = oldest_backup_to_keep[1]
         logger.debug("The oldest backup we get to keep is from %s.",
                   last_date_to_keep)
-        deleted = 0
         # Note: this also deletes now outdated .deltablobs and .dat
         # files, so we may easily delete more items than there are
         # fullbackups (so num_backups + deleted may be more than
         # len(fullbackups).
-        for filename, modtime in files_modtimes:
-            if modtime < last_date_to_keep:
-                filepath = os.path.join(backup_location, filename)
-                os.remove(filepath)
-                logger.debug("Deleted %s.", filepath)
-                deleted += 1
+        deleted = remove_files(
+            backup_location, [filename for filename, modtime in files_modtimes
+                              if modtime < last_date_to_keep])
         logger.info("Removed %d file(s) belonging to old backups, the latest "
                     "%s full backups have been kept.", deleted,
                     str(num_backups))
@@ -323,3 +305,85 @@ def cleanup(backup_location, keep=0):
         if num_backups == 0:
             logger.debug("Reason: max # of backups is 0, so that is a "
                       "sign to us to not remove backups.")
+
+
+def list_modtimes(directory):
+    """Return (filename, modification time) for all files in directory.
+
+    With os.scandir the modification time comes from a single stat call
+    per entry (or none at all on Windows).
+
+      >>> mkdir('modtimes')
+      >>> write('modtimes', 'a.blobs', 'a')
+      >>> write('modtimes', 'b.blobs', 'b')
+      >>> os.utime(join('modtimes', 'a.blobs'), (1000, 1000))
+      >>> os.utime(join('modtimes', 'b.blobs'), (2000, 2000))
+      >>> sorted(list_modtimes('modtimes'))
+      [('a.blobs', 1000.0), ('b.blobs', 2000.0)]
+
+    Without os.scandir (Python 2) we get the same:
+
+      >>> from collective.recipe.backup import repoborunner
+      >>> orig_scandir = repoborunner.scandir
+      >>> repoborunner.scandir = None
+      >>> sorted(list_modtimes('modtimes'))
+      [('a.blobs', 1000.0), ('b.blobs', 2000.0)]
+      >>> repoborunner.scandir = orig_scandir
+      >>> remove('modtimes')
+
+    """
+    if scandir is None:
+        return [(filename, os.path.getmtime(os.path.join(directory, filename)))
+                for filename in os.listdir(directory)]
+    return [(entry.name, entry.stat().st_mtime)
+            for entry in scandir(directory)]
+
+
+def remove_files(directory, filenames):
+    """Remove the files from directory and return how many were removed.
+
+    Where possible, unlink relative to an open descriptor of the directory,
+    so its path is not looked up again for every file.
+
+      >>> mkdir('old')
+      >>> for name in ['1.blobs', '1.deltablobs', '2.blobs', '3.blobs']:
+      ...     write('old', name, 'dummycontents')
+      >>> remove_files('old', ['1.blobs', '1.deltablobs'])
+      2
+      >>> ls('old')
+      -  2.blobs
+      -  3.blobs
+
+    Without support for that (Python 2, Windows), the files are removed by
+    their full path:
+
+      >>> from collective.recipe.backup import repoborunner
+      >>> orig_use_dir_fd = repoborunner.USE_DIR_FD
+      >>> repoborunner.USE_DIR_FD = False
+      >>> remove_files('old', ['2.blobs'])
+      1
+      >>> ls('old')
+      -  3.blobs
+      >>> repoborunner.USE_DIR_FD = orig_use_dir_fd
+
+    Nothing to remove is fine too:
+
+      >>> remove_files('old', [])
+      0
+      >>> remove('old')
+
+    """
+    base = os.path.join(directory, '')
+    if USE_DIR_FD:
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            for filename in filenames:
+                os.unlink(filename, dir_fd=dir_fd)
+                logger.debug("Deleted %s.", base + filename)
+        finally:
+            os.close(dir_fd)
+    else:
+        for filename in filenames:
+            os.remove(base + filename)
+            logger.debug("Deleted %s.", base + filename)
+    return len(filenames)
@@ -11,6 +11,7 @@ import zc.buildout.testing
 import collective.recipe.backup
 from collective.recipe.backup import repozorunner
 from collective.recipe.backup import repoborunner
+from collective.recipe.backup import repobo
 from zope.testing import doctest, renormalizing
 
 # Importing modules so that we can install their eggs in the test buildout.
@@ -70,6 +71,13 @@ def test_suite():
                 optionflags=optionflags,
                 checker=checker,
                 ),
+            doctest.DocTestSuite(
+                repobo,
+                setUp=setUp,
+                tearDown=zc.buildout.testing.buildoutTearDown,
+                optionflags=optionflags,
+                checker=checker,
+                ),
             ))
     return suite
 